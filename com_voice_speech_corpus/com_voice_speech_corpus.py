@@ -99,11 +99,10 @@ class ComVoiceSpeechCorpus(datasets.GeneratorBasedBuilder):
 
         data = list(zip(paths, labls))
         random.Random(4).shuffle(data)
-        paths, labls = zip(*data)
-        for i in range(len(paths)):
+        for i, (path, label) in enumerate(data):
           example = {
-              "file": paths[i],
-              "label":labls[i]
+              "file": path,
+              "label": label
           }
           yield str(i), example
 
@@ -2,11 +2,15 @@
 
 from __future__ import absolute_import, division, print_function
 
+import itertools
 import os
+from concurrent.futures import ThreadPoolExecutor
 
 import datasets
+import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
 import soundfile as sf
-import random
 
 _CITATION = """
 """
@@ -44,10 +48,19 @@ class ComVoiceSpeechCorpus5Config(datasets.BuilderConfig):
         super(ComVoiceSpeechCorpus5Config, self).__init__(version=datasets.Version("2.1.0", ""), **kwargs)
 
 
+def _read_segment(file, segment):
+    # segment is encoded as "<start>_<stop>", sf.read wants ints not strings
+    start, stop = segment.split('_')
+    speech_array, _ = sf.read(file, start=int(start), stop=int(stop))
+    return speech_array
+
+
 def map_to_array(batch):
-    start, stop = batch['segment'].split('_')
-    speech_array, _ = sf.read(batch["file"], start=start, stop=stop)
-    batch["speech"] = speech_array
+    # libsndfile releases the GIL while decoding, so reading a batch through a
+    # thread pool overlaps the file reads; call via
+    # dataset.map(map_to_array, batched=True, batch_size=32)
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        batch["speech"] = list(executor.map(_read_segment, batch["file"], batch["segment"]))
     return batch
 
 
@@ -92,23 +105,28 @@ class ComVoiceSpeechCorpus5(datasets.GeneratorBasedBuilder):
         """Generate examples from a Librispeech archive_path."""
         wav_dir = archive_path
 
-        paths = []
-        labls = []
-
-        for _, c in enumerate(os.listdir(wav_dir)):
-            if os.path.isdir(f'{wav_dir}/{c}/'):
-                for file in os.listdir(f'{wav_dir}/{c}/')[:4000]:
-                    if file.endswith('.mp3'):
-                        wav_path = f'{wav_dir}/{c}/{file}'
-                        paths.append(wav_path)
-                        labls.append(c)
-
-        data = list(zip(paths, labls))
-        random.Random(4).shuffle(data)
-        paths, labls = zip(*data)
-        for i in range(len(paths)):
+        # the directory walk is all metadata syscalls, which is the slow part on
+        # the cluster filesystem, so the discovered (file, label) pairs are
+        # dumped to a parquet manifest once and read back on later builds
+        manifest_path = os.path.join(wav_dir, "manifest.parquet")
+        if os.path.exists(manifest_path):
+            manifest = pq.read_table(manifest_path)
+            entries = list(zip(manifest['file'].to_pylist(), manifest['label'].to_pylist()))
+        else:
+            # scandir avoids a stat syscall per entry since the dirent already knows its type
+            entries = []
+            for c_entry in os.scandir(wav_dir):
+                if c_entry.is_dir():
+                    for file_entry in itertools.islice(os.scandir(c_entry.path), 4000):
+                        if file_entry.name.endswith('.mp3'):
+                            entries.append((file_entry.path, c_entry.name))
+            pq.write_table(pa.table({"file": [e[0] for e in entries],
+                                     "label": [e[1] for e in entries]}), manifest_path)
+
+        for i, j in enumerate(np.random.default_rng(4).permutation(len(entries))):
+            wav_path, label = entries[j]
             example = {
-                "file": paths[i],
-                "label": labls[i]
+                "file": wav_path,
+                "label": label
             }
             yield str(i), example
@@ -6,12 +6,12 @@ from dataclasses import dataclass
 from typing import Dict, List, Optional, Union
 
 import datasets
-import librosa
 import numpy as np
 import pandas as pd
 import soundfile as sf
 import torch
 import torchaudio
+import torchaudio.functional as AF
 import transformers
 import wandb
 from packaging import version
@@ -77,32 +77,49 @@ class DataCollatorCTCWithPadding:
     pad_to_multiple_of_labels: Optional[int] = None
     number_of_labels: Optional[int] = 5
 
+    def __post_init__(self):
+        # reusable staging buffers keyed by batch size; pinned on gpu hosts so
+        # the later .to('cuda') copies straight out of page-locked memory
+        # instead of allocating + pin-copying a fresh tensor every step
+        self._pin = torch.cuda.is_available()
+        self._value_bufs = {}
+        self._mask_bufs = {}
+
+    def _buffers(self, batch_size):
+        if batch_size not in self._value_bufs:
+            self._value_bufs[batch_size] = torch.empty((batch_size, self.max_length),
+                                                       dtype=torch.float32, pin_memory=self._pin)
+            self._mask_bufs[batch_size] = torch.empty((batch_size, self.max_length),
+                                                      dtype=torch.long, pin_memory=self._pin)
+        return self._value_bufs[batch_size], self._mask_bufs[batch_size]
+
     def __call__(self, features: List[Dict[str, Union[List[int], torch.Tensor]]]) -> Dict[str, torch.Tensor]:
         # split inputs and labels since they have to be of different lenghts and need
         # different padding methods
 
-        input_features = [{"input_values": feature["input_values"]} for feature in features]
-
-        def onehot(lbl):
-            onehot = [0] * self.number_of_labels
-            onehot[int(lbl)] = 1
-            return onehot
-
-        output_features = [onehot(feature["labels"]) for feature in features]
-
-        batch = self.processor.pad(
-            input_features,
-            padding=True,
-            max_length=self.max_length,
-            pad_to_multiple_of=self.pad_to_multiple_of,
-            return_tensors="pt",
-        )
-        # for val in batch['input_values']:
-        #   print(val[:10])
-        #   print(val[-10:])
-        # print(batch['input_values'].shape)
-        batch["labels"] = torch.tensor(output_features)
-        # print(batch["labels"].argmax(-1))
+        # one-hot encode in C via scatter_ instead of building a python list per sample,
+        # torch.from_numpy wraps the fromiter buffer without a copy
+        labels = torch.from_numpy(np.fromiter((int(feature["labels"]) for feature in features),
+                                              dtype=np.int64, count=len(features)))
+        onehot = torch.zeros(len(features), self.number_of_labels, dtype=torch.float32)
+        onehot.scatter_(1, labels.unsqueeze(1), 1.0)
+
+        # every batch is padded to the fixed window length (max_length equals
+        # pad_to_multiple_of), so the rows can be written straight into the
+        # preallocated buffers, 0.0 is the extractor's padding_value
+        input_values, attention_mask = self._buffers(len(features))
+        input_values.zero_()
+        attention_mask.zero_()
+        for i, feature in enumerate(features):
+            row = torch.as_tensor(feature["input_values"], dtype=torch.float32)[:self.max_length]
+            input_values[i, :len(row)] = row
+            attention_mask[i, :len(row)] = 1
+
+        batch = {
+            "input_values": input_values,
+            "attention_mask": attention_mask,
+            "labels": onehot,
+        }
         return batch
 
 
@@ -156,12 +173,9 @@ def main():
 
     # Get the datasets:
 
-    labels_csv = pd.read_csv(data_args.labels_csv)
-    label_idx = []
-    label_names = []
-    for i in range(0, len(labels_csv)):
-        label_idx.append(labels_csv.iloc[i, 0])
-        label_names.append(labels_csv.iloc[i, 1])
+    labels_csv = pd.read_csv(data_args.labels_csv, engine='c')
+    label_idx = labels_csv.iloc[:, 0].to_numpy().tolist()
+    label_names = labels_csv.iloc[:, 1].to_numpy().tolist()
 
     train_dataset = datasets.load_dataset("DidDataset.py", data_dir=data_args.data_path, split="train",
                                           data_files={'labels_csv': data_args.labels_csv},
@@ -201,53 +215,106 @@ def main():
 
     # Preprocessing the datasets.
     # We need to read the audio files as arrays and tokenize the targets.
-    def speech_file_to_array_fn(batch):
+    # Decoding mp3/wav and resampling dominates preprocessing time, so it is done
+    # exactly once per corpus: every utterance gets decoded, resampled to 16 kHz
+    # and appended as int16 mono PCM to a flat .bin cache with an (offset, length)
+    # parquet index next to it. The map stages below only slice a read-only
+    # np.memmap of that cache, so repeated epochs/runs are plain mmap reads.
+    pcm_cache_dir = os.path.join(model_args.cache_dir if model_args.cache_dir else data_args.data_path, "pcm16k")
+    os.makedirs(pcm_cache_dir, exist_ok=True)
+
+    def decode_to_16k(file):
         start = 0
         stop = data_args.window_length
         srate = 16_000
-        if batch["file"].endswith('.wav'):
-            speech_array, sampling_rate = sf.read(batch["file"], start=start * srate, stop=stop * srate)
-        elif batch["file"].endswith('.mp3'):
-            speech_array, sampling_rate = torchaudio.load(batch["file"])
-            speech_array = speech_array[0].numpy()[:stop * srate]
-        batch["speech"] = librosa.resample(np.asarray(speech_array), sampling_rate, srate)
-        batch["sampling_rate"] = srate
-        batch["parent"] = batch["label"]
-        return batch
-
-    train_dataset = train_dataset.map(
-        speech_file_to_array_fn,
-        remove_columns=train_dataset.column_names,
-        num_proc=data_args.preprocessing_num_workers,
+        if file.endswith('.wav'):
+            # read exactly the window as float32 in one call, sf.read would hand
+            # back float64 and double the bytes moved
+            with sf.SoundFile(file) as f:
+                sampling_rate = f.samplerate
+                f.seek(start * sampling_rate)
+                speech_array = f.read(frames=(stop - start) * sampling_rate, dtype='float32', always_2d=False)
+            speech_array = torch.from_numpy(speech_array)
+        elif file.endswith('.mp3'):
+            # bound the decode to the window so the codec stops early instead of
+            # decoding the whole file and throwing most of it away
+            sampling_rate = torchaudio.info(file).sample_rate
+            speech_array, sampling_rate = torchaudio.load(file, frame_offset=start * sampling_rate,
+                                                          num_frames=stop * sampling_rate)
+            speech_array = speech_array[0]
+        if sampling_rate != srate:
+            speech_array = AF.resample(speech_array, orig_freq=sampling_rate, new_freq=srate,
+                                       resampling_method="sinc_interp_kaiser")
+        return speech_array.numpy()
+
+    def build_pcm_cache(dataset, split):
+        bin_path = os.path.join(pcm_cache_dir, split + ".bin")
+        idx_path = os.path.join(pcm_cache_dir, split + ".parquet")
+        if os.path.exists(bin_path) and os.path.exists(idx_path):
+            if len(pd.read_parquet(idx_path)) == len(dataset):
+                logger.info(f"Reusing PCM cache {bin_path}")
+                return bin_path, idx_path
+            logger.info(f"PCM cache {bin_path} does not match dataset size, rebuilding")
+        offsets = []
+        lengths = []
+        offset = 0
+        with open(bin_path, 'wb') as pcm_file:
+            for file in dataset["file"]:
+                pcm = np.clip(decode_to_16k(file) * 32768.0, -32768, 32767).astype(np.int16)
+                pcm_file.write(pcm.tobytes())
+                offsets.append(offset)
+                lengths.append(len(pcm))
+                offset += len(pcm)
+        pd.DataFrame({"offset": offsets, "length": lengths}).to_parquet(idx_path)
+        return bin_path, idx_path
+
+    def make_prepare_dataset_fn(bin_path, idx_path):
+        index = pd.read_parquet(idx_path)
+        offsets = index["offset"].to_numpy()
+        lengths = index["length"].to_numpy()
+
+        def prepare_dataset(batch, idxs):
+            # memmap is opened per call so the function stays picklable for num_proc workers
+            pcm = np.memmap(bin_path, dtype=np.int16, mode='r')
+            speech = [pcm[offsets[i]:offsets[i] + lengths[i]].astype(np.float32) * (1.0 / 32768.0)
+                      for i in idxs]
+            # the cache is written at a fixed 16 kHz, see build_pcm_cache
+            batch["input_values"] = processor(speech, sampling_rate=16_000).input_values
+            batch["labels"] = batch["label"]
+            return batch
+
+        return prepare_dataset
+
+    # the cache and the extractor have to agree on the rate; checked once here
+    # instead of hashing a sampling_rate column per batch in the map stages
+    assert processor.feature_extractor.sampling_rate == 16_000, (
+        f"PCM cache is written at 16 kHz but the feature extractor expects "
+        f"{processor.feature_extractor.sampling_rate}."
     )
-    eval_dataset = eval_dataset.map(
-        speech_file_to_array_fn,
-        remove_columns=eval_dataset.column_names,
-        num_proc=data_args.preprocessing_num_workers,
-    )
-
-    def prepare_dataset(batch):
-        # check that all files have the correct sampling rate
-        assert (
-                len(set(batch["sampling_rate"])) == 1
-        ), f"Make sure all inputs have the same sampling rate of {processor.feature_extractor.sampling_rate}."
-        batch["input_values"] = processor(batch["speech"], sampling_rate=batch["sampling_rate"][0]).input_values
-        batch["labels"] = batch["parent"]
-        return batch
 
+    train_bin_path, train_idx_path = build_pcm_cache(train_dataset, "train")
     train_dataset = train_dataset.map(
-        prepare_dataset,
+        make_prepare_dataset_fn(train_bin_path, train_idx_path),
         remove_columns=train_dataset.column_names,
-        batch_size=training_args.per_device_train_batch_size,
         batched=True,
+        batch_size=training_args.per_device_train_batch_size,
+        with_indices=True,
         num_proc=data_args.preprocessing_num_workers,
+        writer_batch_size=256,
+        keep_in_memory=False,
+        load_from_cache_file=not data_args.overwrite_cache,
     )
+    eval_bin_path, eval_idx_path = build_pcm_cache(eval_dataset, "eval")
     eval_dataset = eval_dataset.map(
-        prepare_dataset,
+        make_prepare_dataset_fn(eval_bin_path, eval_idx_path),
         remove_columns=eval_dataset.column_names,
-        batch_size=training_args.per_device_train_batch_size,
         batched=True,
+        batch_size=training_args.per_device_train_batch_size,
+        with_indices=True,
         num_proc=data_args.preprocessing_num_workers,
+        writer_batch_size=256,
+        keep_in_memory=False,
+        load_from_cache_file=not data_args.overwrite_cache,
     )
 
     from sklearn.metrics import classification_report, confusion_matrix
@@ -8,8 +8,9 @@ import numpy as np
 import torch
 import torch.nn.functional as F
 import torch.optim as optim
-from torch.nn import DataParallel
+from torch.nn.parallel import DistributedDataParallel
 from torch.utils.data import SubsetRandomSampler
+from torch.utils.data.distributed import DistributedSampler
 
 import wandb
 from DidDataset import DidDataset
@@ -32,9 +33,11 @@ def print_Config():
     print("  num_classes: " + str(config.model['num_classes']) + ", freeze_fairseq: " + str(
         config.model['freeze_fairseq']))
     print('general:')
-    print("  num_workers: " + str(config.general['num_workers']))
+    print("  num_workers: " + str(config.general['num_workers']) + ", persistent_workers: " + str(
+        config.general['persistent_workers']) + ", prefetch_factor: " + str(config.general['prefetch_factor']))
     print("  epochs: " + str(config.general['epochs']))
     print("  optimizer: " + config.general['optimizer'])
+    print("  amp_dtype: " + config.general.get('amp_dtype', 'off'))
     print("  loss_function: " + config.general['loss_function'])
     print("  log_interval: " + str(config.general['log_interval']) + ", model_save_interval: " + str(
         config.general['model_save_interval']))
@@ -45,18 +48,24 @@ if __name__ == "__main__":
     with open(config_path) as f:
         did_config = json.load(f)
 
-    # get device on which training should run
-    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    # multi gpu runs are launched via torchrun with one process per gpu,
+    # LOCAL_RANK is set by the launcher
+    local_rank = int(os.environ.get('LOCAL_RANK', -1))
+    distributed = local_rank >= 0
+    if distributed:
+        torch.distributed.init_process_group(backend='nccl')
+        torch.cuda.set_device(local_rank)
+        device = torch.device('cuda', local_rank)
+        print("Running distributed on rank", torch.distributed.get_rank(),
+              "of", torch.distributed.get_world_size())
+        if torch.distributed.get_rank() != 0:
+            os.environ['WANDB_MODE'] = 'disabled'  # only rank 0 talks to wandb
+    else:
+        # get device on which training should run
+        device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    # batch_size has to stay the same even if we are on multiple gpus
+    # batch_size is per process, with DDP every rank trains on its own shard
     batch_size_test = did_config['data']['batch_size']
-    # Using more than one GPU
-    if torch.cuda.device_count() > 1:
-        device_count = torch.cuda.device_count()
-        print("Using:", device_count, "GPUs!")
-        did_config['data']['batch_size'] = did_config['data']['batch_size'] * device_count
-        batch_size_test = batch_size_test * device_count
-        print("Multiplying batch * GPUs new batch_size=", did_config['data']['batch_size'])
 
     os.environ['WANDB_PROJECT'] = 'w2v_did'
     os.environ['WANDB_LOG_MODEL'] = 'true'
@@ -73,8 +82,12 @@ if __name__ == "__main__":
     wandb.save("*.pt")
 
     # define params for data loaders
+    # device is a torch.device, so comparing it against the string 'cuda' was always False
+    # and pin_memory silently stayed off on gpu runs
     kwargs = {'num_workers': config.general['num_workers'],
-              'pin_memory': True} if device == 'cuda' else {}  # needed for using datasets on gpu
+              'pin_memory': True,
+              'persistent_workers': config.general['persistent_workers'],
+              'prefetch_factor': config.general['prefetch_factor']} if torch.cuda.is_available() else {}  # needed for using datasets on gpu
 
     # build train data
     csv_path_train = config.data['train_dataset'] + 'metadata.csv'  # file_path_train = './data/dev/segmented/'
@@ -93,20 +106,29 @@ if __name__ == "__main__":
     print("Test set size: " + str(len(test_idx)))
 
     # build data loaders
-    train_loader = torch.utils.data.DataLoader(train_set,
-                                               batch_size=config.data['batch_size'],
-                                               shuffle=config.data['shuffle'],
-                                               drop_last=True,
-                                               **kwargs)
+    if distributed:
+        train_sampler = DistributedSampler(train_set, shuffle=config.data['shuffle'])
+        train_loader = torch.utils.data.DataLoader(train_set,
+                                                   batch_size=config.data['batch_size'],
+                                                   sampler=train_sampler,
+                                                   drop_last=True,
+                                                   **kwargs)
+    else:
+        train_sampler = None
+        train_loader = torch.utils.data.DataLoader(train_set,
+                                                   batch_size=config.data['batch_size'],
+                                                   shuffle=config.data['shuffle'],
+                                                   drop_last=True,
+                                                   **kwargs)
     test_loader = torch.utils.data.DataLoader(test_set,
                                               batch_size=batch_size_test,
                                               sampler=SubsetRandomSampler(test_idx),
                                               drop_last=True,
                                               **kwargs)
 
-    # Loss Function and fitting exponential normalizing function
+    # the models compute nll_loss inside forward when labels are passed, the
+    # config check stays to pick the matching exponential normalizing function
     if config.general['loss_function'] == 'nllLoss':
-        loss_function = F.nll_loss
         exp_norm_func = F.log_softmax
     else:
         raise SystemExit("you must specify loss_function for " + config.general['loss_function'])
@@ -123,10 +145,26 @@ if __name__ == "__main__":
             exp_norm_func=exp_norm_func,
             freeze_fairseq=config.model['freeze_fairseq'])
 
+    amp_dtype = config.general.get('amp_dtype', 'off')
+
     # Using more than one GPU
-    if torch.cuda.device_count() > 1:
-        print("Wrapping model with DataParallel")
-        model = DataParallel(model)
+    if distributed:
+        print("Wrapping model with DistributedDataParallel")
+        # DDP overlaps the bucketed nccl all-reduce with backward, the model has
+        # to live on its gpu in its final dtype before wrapping (the runner's
+        # .to() and dtype cast are then no-ops)
+        model = model.float() if amp_dtype != 'off' else model.double()
+        model = DistributedDataParallel(model.to(device),
+                                        device_ids=[local_rank],
+                                        bucket_cap_mb=25,
+                                        gradient_as_bucket_view=True)
+
+    # inductor fuses the pointwise/layernorm/gelu chains in the wav2vec encoder;
+    # batches are padded to a fixed window so shapes are static and the guard
+    # machinery can be skipped with dynamic=False
+    if hasattr(torch, 'compile'):
+        print("Compiling model with torch.compile")
+        model = torch.compile(model, mode='reduce-overhead', fullgraph=False, dynamic=False)
 
     # Optimizer
     print('optimizer_params:')
@@ -134,14 +172,17 @@ if __name__ == "__main__":
         print('  lr: ' + str(config.optimizers[config.general['optimizer']]['lr']) + ', weight_decay: ' + str(
             config.optimizers[config.general['optimizer']]['weight_decay']))
 
-        if torch.cuda.device_count() > 1:
+        # fused Adam does all moment updates in a single multi-tensor cuda kernel
+        # instead of launching a handful of kernels per parameter tensor
+        try:
             optimizer = optim.Adam(model.parameters(),
-                               lr=config.optimizers[config.general['optimizer']]['lr'],
-                               weight_decay=config.optimizers[config.general['optimizer']]['weight_decay'])
-        else:
+                                   lr=config.optimizers[config.general['optimizer']]['lr'],
+                                   weight_decay=config.optimizers[config.general['optimizer']]['weight_decay'],
+                                   fused=torch.cuda.is_available())
+        except TypeError:  # torch < 1.13 has no fused adam
             optimizer = optim.Adam(model.parameters(),
-                               lr=config.optimizers[config.general['optimizer']]['lr'],
-                               weight_decay=config.optimizers[config.general['optimizer']]['weight_decay'])
+                                   lr=config.optimizers[config.general['optimizer']]['lr'],
+                                   weight_decay=config.optimizers[config.general['optimizer']]['weight_decay'])
     else:
         raise SystemExit("you must specify optimizer for " + config.general['optimizer'])
 
@@ -158,11 +199,18 @@ if __name__ == "__main__":
                             optimizer=optimizer,
                             scheduler=scheduler,
                             wandb=wandb,
-                            loss_function=loss_function)
+                            amp_dtype=amp_dtype)
 
-    wandb.watch(model, log="all")
+    # watch(log='all') drags every gradient tensor to cpu and serializes it on
+    # each log step, tens of MB per log for xlsr, so gradient logging is opt-in
+    if config.general.get('watch_gradients', False):
+        wandb.watch(model, log="gradients", log_freq=1000)
+    else:
+        wandb.watch(model, log=None)  # parameter counts only, no tensor uploads
 
     for epoch in range(1, config.general['epochs'] + 1):
+        if train_sampler is not None:
+            train_sampler.set_epoch(epoch)  # reshuffle shards every epoch
         t = time.time()
         closs = runner.train(train_loader=train_loader,
                              epoch=epoch,
@@ -177,9 +225,10 @@ if __name__ == "__main__":
             vloss = runner.test(test_loader=test_loader, log_interval=config.general['log_interval'])
             # wandb.log({"validation loss": vloss / (len(test_loader.dataset) / config.data['batch_size'])})
             wandb.log({"eval_duration": (time.time() - t)})
-            model_path = wandb.run.dir + '/did_model_epoch_' + str(epoch) + '.pt'
-            print("Saving model to " + model_path)
-            torch.save(model.state_dict(), model_path)
+            if not distributed or torch.distributed.get_rank() == 0:
+                model_path = wandb.run.dir + '/did_model_epoch_' + str(epoch) + '.pt'
+                print("Saving model to " + model_path)
+                torch.save(model.state_dict(), model_path)
 
         scheduler.step()
         wandb.log({"learning rate": optimizer.param_groups[0]['lr']})
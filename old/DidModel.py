@@ -1,6 +1,7 @@
 import fairseq
 import torch
 import torch.nn as nn
+import torch.nn.functional as F
 import time
 from fairseq.modules import GradMultiply
 
@@ -41,7 +42,7 @@ class DidModel(nn.Module):
                 param.requires_grad = False
 
 
-    def forward(self, source, padding_mask=None, mask=True, features_only=False):
+    def forward(self, source, labels=None, padding_mask=None, mask=True, features_only=False):
 
         # FAIRSEQ CODE wav2vec.py start
         if self.model.feature_grad_mult > 0:
@@ -165,4 +166,9 @@ class DidModel(nn.Module):
         x = torch.nn.functional.softmax(x, dim=1)
         result = {"x": x, "normalized": normalized}
 
+        # computing the loss inside forward keeps the criterion on each replica,
+        # only a scalar has to cross the gather/all-reduce boundary
+        if labels is not None:
+            result["loss"] = F.nll_loss(normalized, labels)
+
         return result
@@ -26,7 +26,7 @@ class DidModelClassifierOnly(nn.Module):
                 param.requires_grad = False
             self.dfs_freeze(child)
 
-    def forward(self, source):
+    def forward(self, source, labels=None):
 
         # reduce dimension with mean
 
@@ -37,4 +37,8 @@ class DidModelClassifierOnly(nn.Module):
         x = F.softmax(x, dim=1)
 
         result = {"x": x, "normalized": normalized}
+
+        if labels is not None:
+            result["loss"] = F.nll_loss(normalized, labels)
+
         return result
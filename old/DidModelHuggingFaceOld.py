@@ -46,7 +46,7 @@ class DidModelHuggingFaceOld(nn.Module):
                 param.requires_grad = False
             self.dfs_freeze(child)
 
-    def forward(self, source):
+    def forward(self, source, labels=None):
         outputs = self.model(source)
 
         # reduce dimension with mean
@@ -63,4 +63,8 @@ class DidModelHuggingFaceOld(nn.Module):
         x = F.softmax(x, dim=1)
 
         result = {"x": x, "normalized": normalized}
+
+        if labels is not None:
+            result["loss"] = F.nll_loss(normalized, labels)
+
         return result
@@ -3,18 +3,29 @@ import torch
 
 class DidModelRunner:
 
-    def __init__(self, device, model, optimizer, scheduler, wandb, loss_function):
+    # amp_dtype: 'off' keeps the historical float64 path, 'fp16'/'bf16' run the
+    # forward/backward under torch.autocast with float32 master weights
+    def __init__(self, device, model, optimizer, scheduler, wandb, amp_dtype='off'):
         self.device = device
         self.wandb = wandb
-        print('running on device: ', self.device)
+        print('running on device: ', self.device, ', amp_dtype: ', amp_dtype)
+
+        self.amp_dtype = {'fp16': torch.float16, 'bf16': torch.bfloat16}.get(amp_dtype)
 
         self.model = model
-        self.model = self.model.double()
+        self.model = self.model.float() if self.amp_dtype is not None else self.model.double()
         self.model.to(self.device)
 
+        # the scaler is a no-op unless fp16 is active (bf16 has fp32's exponent range)
+        self.scaler = torch.cuda.amp.GradScaler(enabled=(self.amp_dtype == torch.float16))
+
         self.optimizer = optimizer
         self.scheduler = scheduler
-        self.loss_function = loss_function
+
+    def autocast(self):
+        return torch.autocast(device_type=self.device.type,
+                              dtype=self.amp_dtype,
+                              enabled=self.amp_dtype is not None)
 
     def train(self, train_loader, epoch, log_interval):
         self.model.train()
@@ -22,16 +33,21 @@ class DidModelRunner:
         t = time.time()
         for batch_idx, (data, target) in enumerate(train_loader):
             self.wandb.log({"dataload_duration": (time.time() - t)})
-            data = data.to(self.device)
-            target = target.to(self.device)
+            data = data.to(self.device, non_blocking=True)
+            target = target.to(self.device, non_blocking=True)
+            if self.amp_dtype is not None:
+                data = data.float()
             z = time.time()
-            output = self.model(data)['normalized']
+            with self.autocast():
+                output = self.model(data, labels=target)
             self.wandb.log({"model_calc_duration": (time.time() - z)})
             z = time.time()
-            loss = self.loss_function(output, target)
+            # each replica returns its own loss scalar, average them
+            loss = output['loss'].mean()
             self.optimizer.zero_grad()
-            loss.backward()
-            self.optimizer.step()
+            self.scaler.scale(loss).backward()
+            self.scaler.step(self.optimizer)
+            self.scaler.update()
             self.wandb.log({"batch_loss_calc_duration": (time.time() - z)})
             self.wandb.log({"batch_loss": loss.detach().item()})
             closs = closs + loss.detach().item()
@@ -52,10 +68,13 @@ class DidModelRunner:
             correct = 0
             vloss = 0
             for batch_idx, (data, target) in enumerate(test_loader):
-                data = data.to(self.device)
-                target = target.to(self.device)
+                data = data.to(self.device, non_blocking=True)
+                target = target.to(self.device, non_blocking=True)
+                if self.amp_dtype is not None:
+                    data = data.float()
                 z = time.time()
-                output = self.model(data)
+                with self.autocast():
+                    output = self.model(data)
                 self.wandb.log({"eval_model_calc_duration": (time.time() - z)})
                 # z = time.time()
                 # loss = self.loss_function(output['normalized'], target)  # the loss functions expects a batchSizex5 input